@@ -0,0 +1,118 @@
+#
+#  Copyright (c) 2019 Christof Ruch. All rights reserved.
+#
+#  Dual licensed: Distributed under Affero GPL license by default, an MIT license is available for purchase
+#
+
+# Builds a few small banks, ingests them into a fresh patch database and checks the duplicate and near duplicate
+# reporting, partly through the command line interface. Run from the repository root with: python check_patchdb.py
+
+import contextlib
+import io
+import os
+import random
+import tempfile
+import mido
+
+from dw8000_wav2syx.dw8000_patchdb import add_to_database, load_database, load_sources, find_duplicate_banks, \
+    find_duplicate_patches, find_near_duplicates, describe_row, patchdb, patches_file_name, patch_size
+
+
+def write_bank(filename, bank):
+    mido.write_syx_file(filename, [mido.Message('sysex', data=[0x42, 0x30, 0x03, 0x40] + patch) for patch in bank])
+
+
+def run_patchdb(*arguments):
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        patchdb(list(arguments))
+    return output.getvalue()
+
+
+def check_patchdb(work):
+    random.seed(8000)
+    random_bank = [[random.randrange(32) for _ in range(patch_size)] for _ in range(64)]
+    # Tapes are usually padded with init patches, so repeated patches within a bank are the normal case
+    init_bank = [list(random_bank[0])] + [[0] * patch_size for _ in range(63)]
+    changed_bank = [list(patch) for patch in random_bank]
+    changed_bank[5][3] ^= 1
+    changed_bank[7][0] = (changed_bank[7][0] + 4) % 32
+    # A bank holding two patches that differ in a single parameter
+    similar_bank = [[random.randrange(32) for _ in range(patch_size)] for _ in range(64)]
+    similar_bank[1] = list(similar_bank[0])
+    similar_bank[1][10] ^= 1
+    # Messages one byte short, which must not be cut into rows crossing patch boundaries
+    short_bank = [patch[:patch_size - 1] for patch in random_bank[:patch_size]]
+
+    files = {}
+    for name, bank in [("init", init_bank), ("a", random_bank), ("b", random_bank), ("c", changed_bank),
+                       ("d", random_bank), ("e", similar_bank), ("short", short_bank)]:
+        files[name] = os.path.join(work, name + ".syx")
+        write_bank(files[name], bank)
+    database = os.path.join(work, "db")
+    patches_path = os.path.join(database, patches_file_name)
+
+    # Repeated patches in the first bank of an empty database
+    add_to_database(database, [files["init"]])
+    patches, sources, first_rows = load_database(database)
+    assert len(patches) == 64 and len(sources) == 1
+    assert describe_row(sources, first_rows, 63) == files["init"] + " patch 63"
+
+    # A missing file neither stops the ingest nor leaves rows behind that no source covers
+    add_to_database(database, [files["a"], os.path.join(work, "missing.syx"), files["b"]])
+    patches, sources, first_rows = load_database(database)
+    assert len(patches) == 192 and len(sources) == 3
+    assert os.path.getsize(patches_path) == 192 * patch_size
+
+    # Adding the same file again under a different relative path is skipped
+    add_to_database(database, [os.path.relpath(files["a"])])
+    assert len(load_database(database)[0]) == 192
+
+    # Rows of an interrupted ingest are ignored on load and removed by the next add
+    with open(patches_path, "ab") as patches_file:
+        patches_file.write(bytes(10 * patch_size))
+    assert len(load_database(database)[0]) == 192
+    add_to_database(database, [files["c"]], max_distance=2, unique_only=True)
+    patches, sources, first_rows = load_database(database)
+    assert len(patches) == 194
+    assert os.path.getsize(patches_path) == 194 * patch_size
+
+    # A bank consisting of known patches only stores no rows, but is recorded as identical bank and not ingested twice
+    run_patchdb(database, "add", files["d"], "--unique", "True")
+    output = run_patchdb(database, "add", files["d"], "--unique", "True")
+    assert "already in database" in output and "identical bank" not in output
+    patches, sources, first_rows = load_database(database)
+    assert len(patches) == 194 and len(sources) == 5
+    assert find_duplicate_banks(sources) == [[files["a"], files["b"], files["d"]]]
+    assert "Identical banks: %s, %s, %s" % (files["a"], files["b"], files["d"]) in run_patchdb(database, "duplicates")
+    assert [files["init"] + " patch 0", files["a"] + " patch 0", files["b"] + " patch 0"] in \
+           [[describe_row(sources, first_rows, row) for row in rows] for rows in find_duplicate_patches(patches)]
+
+    # Near duplicates against the database and within the bank being added
+    changed_patch = changed_bank[7]
+    near = find_near_duplicates(patches, changed_patch, max_distance=4, metric="l1")
+    assert [describe_row(sources, first_rows, row) for row, _ in near] == \
+           [files["c"] + " patch 7", files["a"] + " patch 7", files["b"] + " patch 7"]
+    assert [distance for _, distance in near] == [0, 4, 4]
+    assert find_near_duplicates(patches, changed_patch, max_distance=1)[1][1] == 1
+    output = run_patchdb(database, "add", files["e"], "--distance", "1")
+    assert "%s patch 1 is a near duplicate of %s patch 0, distance 1" % (files["e"], files["e"]) in output
+    output = run_patchdb(database, "query", files["c"], "--patch", "5", "--distance", "1")
+    assert "    %s patch 5, distance 1" % files["a"] in output
+    assert "No patch 64 in" in run_patchdb(database, "query", files["c"], "--patch", "64")
+    assert "No patch database found" in run_patchdb(os.path.join(work, "nodb"), "query", files["c"])
+
+    # Messages of the wrong length are rejected instead of being cut into rows
+    assert "Could not read" in run_patchdb(database, "add", files["short"])
+    assert len(load_database(database)[0]) == 258
+
+    # Patches listed in the sources but missing from the patch file stop further ingests
+    os.truncate(patches_path, 257 * patch_size)
+    assert "Not adding" in run_patchdb(database, "add", files["short"])
+    assert os.path.getsize(patches_path) == 257 * patch_size and len(load_sources(database)) == 6
+
+
+with tempfile.TemporaryDirectory() as work_directory:
+    check_patchdb(work_directory)
+
+print("Patch database check passed")
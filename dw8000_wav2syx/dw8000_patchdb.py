@@ -0,0 +1,313 @@
+#
+#  Copyright (c) 2019 Christof Ruch. All rights reserved.
+#
+#  Dual licensed: Distributed under Affero GPL license by default, an MIT license is available for purchase
+#
+
+import argparse
+import bisect
+import hashlib
+import json
+import os
+import numpy
+from dw8000_wav2syx import dw8000_reverse_engineer
+
+# A DW8000 patch is 51 parameter bytes, the data of a Data Save sysex message after the 4 bytes of header
+patch_size = 51
+patches_file_name = "patches.u8"
+sources_file_name = "sources.json"
+
+
+# The database is a directory holding two files:
+#   patches.u8   - all patches as raw bytes, one row of 51 bytes per patch, appended in order of ingestion
+#   sources.json - one entry per ingested syx file, recording which rows of the patch matrix came from it, a hash of
+#                  the whole bank, and if only some of its patches were stored, their patch numbers within the file
+# The patch file is memory-mapped, so querying does not need to load the archive into RAM
+def database_exists(directory):
+    return os.path.exists(os.path.join(directory, sources_file_name))
+
+
+def load_sources(directory):
+    sources_path = os.path.join(directory, sources_file_name)
+    if not os.path.exists(sources_path):
+        return []
+    with open(sources_path, "r") as sources_file:
+        return json.load(sources_file)
+
+
+# Write to a temporary file first, so an interrupted write can never leave a half written sources list behind
+def save_sources(directory, sources):
+    sources_path = os.path.join(directory, sources_file_name)
+    with open(sources_path + ".tmp", "w") as sources_file:
+        json.dump(sources, sources_file, indent=1)
+    os.replace(sources_path + ".tmp", sources_path)
+
+
+# Rows are written before their source entry, so an ingest interrupted in between leaves rows behind that no source
+# covers. Cut these off before appending, so new rows line up with their source entries again
+def truncate_orphan_rows(directory):
+    patches_path = os.path.join(directory, patches_file_name)
+    expected_size = sum(source["count"] for source in load_sources(directory)) * patch_size
+    if os.path.exists(patches_path) and os.path.getsize(patches_path) > expected_size:
+        print("Removing %d patches of an interrupted ingest from %s" %
+              ((os.path.getsize(patches_path) - expected_size) // patch_size, directory))
+        os.truncate(patches_path, expected_size)
+
+
+def map_patches(directory):
+    patches_path = os.path.join(directory, patches_file_name)
+    if os.path.exists(patches_path) and os.path.getsize(patches_path) >= patch_size:
+        return numpy.memmap(patches_path, dtype=numpy.uint8, mode='r',
+                            shape=(os.path.getsize(patches_path) // patch_size, patch_size))
+    return numpy.zeros((0, patch_size), dtype=numpy.uint8)
+
+
+# Returns the patch matrix, the sources, and the first row of each source for looking up where a row came from
+def load_database(directory):
+    sources = load_sources(directory)
+    row_count = sum(source["count"] for source in sources)
+    patches = map_patches(directory)
+    if len(patches) < row_count:
+        print("Warning - patch database in %s is inconsistent, %d patches but sources list %d" %
+              (directory, len(patches), row_count))
+    # Ignore rows no source covers, they are left over from an interrupted ingest
+    patches = patches[:row_count]
+    first_rows = [source["first_row"] for source in sources]
+    return patches, sources, first_rows
+
+
+# The exact index maps the raw bytes of a patch to all rows holding exactly that patch. It is rebuilt on load,
+# as hashing a few hundred thousand rows of 51 bytes is much quicker than keeping a second file in sync
+def build_hash_index(patches):
+    index = {}
+    for row in range(len(patches)):
+        index.setdefault(patches[row].tobytes(), []).append(row)
+    return index
+
+
+def source_of_row(sources, first_rows, row):
+    position = bisect.bisect_right(first_rows, row) - 1
+    if position < 0 or row >= sources[position]["first_row"] + sources[position]["count"]:
+        raise ValueError("Row %d of the patch database does not belong to any source" % row)
+    source = sources[position]
+    if "patches" in source:
+        # Not all patches of this file were stored, so the patch numbers within the file are listed explicitly
+        return source["file"], source["patches"][row - source["first_row"]]
+    return source["file"], row - source["first_row"]
+
+
+def describe_row(sources, first_rows, row):
+    file, patch_no = source_of_row(sources, first_rows, row)
+    return "%s patch %d" % (file, patch_no)
+
+
+# Distance of one patch to every patch in the matrix, computed in one go over the whole matrix.
+# hamming counts the number of parameters that differ, l1 sums up the absolute differences of the parameter values
+def patch_distances(patches, patch, metric="hamming"):
+    patch = numpy.asarray(patch, dtype=numpy.uint8)
+    if metric == "hamming":
+        return numpy.count_nonzero(patches != patch, axis=1)
+    elif metric == "l1":
+        return numpy.abs(patches.astype(numpy.int16) - patch.astype(numpy.int16)).sum(axis=1)
+    else:
+        raise ValueError("Unknown distance metric %s, use hamming or l1" % metric)
+
+
+# Returns a list of (row, distance) of all patches no further away than max_distance, nearest first
+def find_near_duplicates(patches, patch, max_distance=3, metric="hamming"):
+    if len(patches) == 0:
+        return []
+    distances = patch_distances(patches, patch, metric)
+    rows = numpy.flatnonzero(distances <= max_distance)
+    rows = rows[numpy.argsort(distances[rows], kind='stable')]
+    return [(int(row), int(distances[row])) for row in rows]
+
+
+def read_syx_patches(syxfile):
+    patches = [list(data) for data in dw8000_reverse_engineer.read_sysex(syxfile)]
+    for patch_no, patch in enumerate(patches):
+        if len(patch) != patch_size:
+            raise ValueError("patch %d holds %d bytes instead of %d" % (patch_no, len(patch), patch_size))
+    return numpy.array(patches, dtype=numpy.uint8).reshape(-1, patch_size)
+
+
+def bank_hash(patches):
+    return hashlib.sha1(patches.tobytes()).hexdigest()
+
+
+# Append all patches of the syx files given to the database, creating it if necessary. Files that are already in the
+# database are skipped. For each new file, identical banks and exact and near duplicate patches already stored are
+# reported, so the archive can be deduplicated at ingest time. With unique_only, patches which are already in the
+# database are not stored again, but the file is still recorded as source with the patches it holds
+def add_to_database(directory, syxfiles, max_distance=0, metric="hamming", unique_only=False, verbose=False):
+    os.makedirs(directory, exist_ok=True)
+    truncate_orphan_rows(directory)
+    patches, sources, first_rows = load_database(directory)
+    if len(patches) < sum(source["count"] for source in sources):
+        # Appending now would make the new rows overlap the rows listed for the last sources
+        print("Not adding to %s, patches listed in %s are missing from %s" %
+              (directory, sources_file_name, patches_file_name))
+        return
+    index = build_hash_index(patches)
+    known_files = set(source["file"] for source in sources)
+    banks = {}
+    for source in sources:
+        banks.setdefault(source["bank"], []).append(source["file"])
+    next_row = len(patches)
+
+    with open(os.path.join(directory, patches_file_name), "ab") as patches_file:
+        for syxfile in syxfiles:
+            file_key = os.path.abspath(syxfile)
+            if file_key in known_files:
+                print(syxfile, "already in database, skipping")
+                continue
+            try:
+                new_patches = read_syx_patches(syxfile)
+            except (OSError, ValueError) as e:
+                print("Could not read %s: %s" % (syxfile, e))
+                continue
+            if len(new_patches) == 0:
+                print("No DW8000 patches found in", syxfile)
+                continue
+
+            new_bank = bank_hash(new_patches)
+            for other in banks.get(new_bank, []):
+                print("%s is an identical bank to %s" % (syxfile, other))
+
+            # Register the source up front and count up as patches are stored, so that a patch repeated within
+            # this bank can already be attributed to its earlier occurrence
+            source = {"file": file_key, "bank": new_bank, "first_row": next_row, "count": 0, "patches": []}
+            sources.append(source)
+            first_rows.append(next_row)
+            stored = []
+            for patch_no, patch in enumerate(new_patches):
+                exact = index.get(patch.tobytes(), [])
+                if exact:
+                    print("%s patch %d is a duplicate of %s" %
+                          (syxfile, patch_no, describe_row(sources, first_rows, exact[0])))
+                    if verbose:
+                        for row in exact[1:]:
+                            print("    also", describe_row(sources, first_rows, row))
+                elif max_distance > 0:
+                    near = find_near_duplicates(patches, patch, max_distance, metric)
+                    if stored:
+                        # The patches stored from this bank so far are not in the matrix yet
+                        near += [(next_row + row, distance) for row, distance in
+                                 find_near_duplicates(numpy.array(stored), patch, max_distance, metric)]
+                    if near:
+                        row, distance = min(near, key=lambda hit: hit[1])
+                        print("%s patch %d is a near duplicate of %s, distance %d" %
+                              (syxfile, patch_no, describe_row(sources, first_rows, row), distance))
+                if unique_only and exact:
+                    continue
+                index.setdefault(patch.tobytes(), []).append(next_row + len(stored))
+                stored.append(patch)
+                source["patches"].append(patch_no)
+                source["count"] += 1
+
+            if len(stored) == len(new_patches):
+                del source["patches"]
+            if stored:
+                patches_file.write(numpy.array(stored, dtype=numpy.uint8).tobytes())
+                patches_file.flush()
+            # Save the sources after every file, so an error in a later file does not lose the files already added.
+            # A file with only known patches is kept as well, with no rows, so its bank still counts as a duplicate
+            save_sources(directory, sources)
+            known_files.add(file_key)
+            banks.setdefault(new_bank, []).append(file_key)
+            next_row += len(stored)
+            if stored:
+                # Map the grown file again, so near duplicates within this ingestion run are found as well
+                patches = map_patches(directory)[:next_row]
+                print("Added %d patches from %s" % (len(stored), syxfile))
+            else:
+                print(syxfile, "contains only known patches, nothing stored")
+
+    print("Database %s now holds %d patches from %d files" % (directory, next_row, len(sources)))
+
+
+# All groups of rows holding the identical patch
+def find_duplicate_patches(patches):
+    return [rows for rows in build_hash_index(patches).values() if len(rows) > 1]
+
+
+# All groups of source files holding identical banks, i.e. the same patches in the same order
+def find_duplicate_banks(sources):
+    banks = {}
+    for source in sources:
+        banks.setdefault(source["bank"], []).append(source["file"])
+    return [files for files in banks.values() if len(files) > 1]
+
+
+def patchdb_add(args):
+    add_to_database(args.database, args.syxfiles, max_distance=args.distance, metric=args.metric,
+                    unique_only=args.unique, verbose=args.verbose)
+
+
+def patchdb_duplicates(args):
+    if not database_exists(args.database):
+        print("No patch database found in", args.database)
+        return
+    patches, sources, first_rows = load_database(args.database)
+    for files in find_duplicate_banks(sources):
+        print("Identical banks:", ", ".join(files))
+    if args.verbose:
+        for rows in find_duplicate_patches(patches):
+            print("Identical patches:", ", ".join(describe_row(sources, first_rows, row) for row in rows))
+
+
+def patchdb_query(args):
+    if not database_exists(args.database):
+        print("No patch database found in", args.database)
+        return
+    patches, sources, first_rows = load_database(args.database)
+    try:
+        query = read_syx_patches(args.syxfile)
+    except (OSError, ValueError) as e:
+        print("Could not read %s: %s" % (args.syxfile, e))
+        return
+    if len(query) == 0:
+        print("No DW8000 patches found in", args.syxfile)
+        return
+    if args.patch is not None and not 0 <= args.patch < len(query):
+        print("No patch %d in %s, it holds patches 0 to %d" % (args.patch, args.syxfile, len(query) - 1))
+        return
+    patch_numbers = range(len(query)) if args.patch is None else [args.patch]
+    for patch_no in patch_numbers:
+        print("%s patch %d:" % (args.syxfile, patch_no))
+        for row, distance in find_near_duplicates(patches, query[patch_no], args.distance, args.metric):
+            print("    %s, distance %d" % (describe_row(sources, first_rows, row), distance))
+
+
+def patchdb(arguments=None):
+    parser = argparse.ArgumentParser(prog="dw8000_patchdb",
+                                     description='Collect Korg DW8000 syx files into a patch database and find '
+                                                 'duplicate and near duplicate patches')
+    parser.add_argument('database', help='directory holding the patch database')
+    parser.add_argument('--verbose', type=bool, default=False)
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    add = commands.add_parser('add', help='add syx files to the database')
+    add.add_argument('syxfiles', nargs='+')
+    add.add_argument('--distance', type=int, default=0, help='also report near duplicates up to this distance')
+    add.add_argument('--metric', choices=['hamming', 'l1'], default='hamming')
+    add.add_argument('--unique', type=bool, default=False, help='do not store patches already in the database')
+    add.set_defaults(func=patchdb_add)
+
+    duplicates = commands.add_parser('duplicates', help='list identical banks, and with --verbose identical patches')
+    duplicates.set_defaults(func=patchdb_duplicates)
+
+    query = commands.add_parser('query', help='find the patches of a syx file in the database')
+    query.add_argument('syxfile')
+    query.add_argument('--patch', type=int, default=None, help='only query this patch number of the syx file')
+    query.add_argument('--distance', type=int, default=0)
+    query.add_argument('--metric', choices=['hamming', 'l1'], default='hamming')
+    query.set_defaults(func=patchdb_query)
+
+    args = parser.parse_args(arguments)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    patchdb()
@@ -21,6 +21,7 @@ setuptools.setup(
     python_requires='>=3.6',
     install_requires=[
         "mido",
+        "numpy",
         "scipy"
     ],
     entry_points={
@@ -28,6 +29,7 @@ setuptools.setup(
             'dw8000_bin2syx= dw8000_wav2syx.dw8000_bin2syx:bin2syx',
             'dw8000_wav2bin= dw8000_wav2syx.dw8000_wav2bin:wav2bin',
             'dw8000_wav2syx= dw8000_wav2syx.__main__:wav2syx',
+            'dw8000_patchdb= dw8000_wav2syx.dw8000_patchdb:patchdb',
         ]
     }
 )